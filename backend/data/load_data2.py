@@ -1,9 +1,10 @@
-import json
 import sqlite3
 import re
 import csv
 import os
 import math
+import ijson
+import numpy as np
 from datetime import datetime
 
 # Bras Basah coordinates (approximate center)
@@ -11,90 +12,80 @@ BRAS_BASAH_LAT = 1.2966
 BRAS_BASAH_LON = 103.8517
 MAX_DISTANCE_KM = 5  # Maximum 5km radius from Bras Basah
 
-# Function to calculate distance between two coordinates (Haversine formula)
-def calculate_distance(lat1, lon1, lat2, lon2):
-    """Calculate the great circle distance between two points on the earth"""
+# Function to calculate distances from Bras Basah to many coordinates at once (Haversine formula)
+def calculate_distances(lats, lons):
+    """Calculate the great circle distances from Bras Basah to arrays of points on the earth"""
     # Convert decimal degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    lat0, lon0 = math.radians(BRAS_BASAH_LAT), math.radians(BRAS_BASAH_LON)
+    lats, lons = np.radians(lats), np.radians(lons)
     
     # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-    c = 2 * math.asin(math.sqrt(a))
+    a = np.sin((lats - lat0) / 2)**2 + math.cos(lat0) * np.cos(lats) * np.sin((lons - lon0) / 2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
     r = 6371  # Radius of earth in kilometers
     return c * r
 
-# Function to extract data from Description HTML
-def extract_from_description(desc_html, field_name):
-    """Extract field value from HTML description"""
-    pattern = fr'<th>{field_name}<\/th>\s*<td>([^<]*)<\/td>'
-    match = re.search(pattern, desc_html)
-    return match.group(1) if match else ''
+# Function to pick the stalls closest to Bras Basah from arrays of coordinates
+def find_nearest(lats, lons, k, max_distance):
+    """Return the indices and distances of the k closest points within max_distance km, nearest first"""
+    distances = calculate_distances(lats, lons)
+    in_range = np.flatnonzero(distances <= max_distance)
+    if len(in_range) > k:
+        # Only sort the points up to the k-th smallest distance (ties included, so that
+        # the stable sort still picks the same stalls as a full sort would)
+        kth_distance = np.partition(distances[in_range], k - 1)[k - 1]
+        in_range = in_range[distances[in_range] <= kth_distance]
+    nearest = in_range[np.argsort(distances[in_range], kind='stable')[:k]]
+    return nearest, distances[nearest]
 
-# Connect to SQLite database (creates it if it doesn't exist)
-conn = sqlite3.connect('hpb_food_stalls.db')
-cursor = conn.cursor()
+# Function to sort a price range like '5-10' or '10+' by its lower bound
+def price_sort_key(price_range):
+    """Return the lower bound of a price range; the CSV is edited by hand, so anything unparseable (e.g. 'N/A') sorts last"""
+    try:
+        return float(price_range.split('-')[0].replace('+', ''))
+    except ValueError:
+        return math.inf
 
-# Drop existing tables if they exist for a clean start
-cursor.execute('DROP TABLE IF EXISTS stall_attributes')
-cursor.execute('DROP TABLE IF EXISTS stalls')
+# Matches every <th>FIELD</th> <td>value</td> pair of the Description HTML table
+FIELD_RE = re.compile(r'<th>([A-Z_]+)<\/th>\s*<td>([^<]*)<\/td>')
 
-# Create tables
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS stalls (
-    id INTEGER PRIMARY KEY,
-    name TEXT,
-    description TEXT,
-    address_block TEXT,
-    address_building TEXT,
-    address_postal_code TEXT,
-    address_street TEXT,
-    address_floor TEXT,
-    address_unit TEXT,
-    latitude REAL,
-    longitude REAL,
-    address_type TEXT,
-    last_updated TEXT,
-    distance_from_bras_basah REAL
-)
-''')
+# Connect to SQLite database (creates it if it doesn't exist); autocommit mode so that
+# transactions are only opened by the explicit BEGIN/COMMIT below
+conn = sqlite3.connect('hpb_food_stalls.db', isolation_level=None)
+cursor = conn.cursor()
 
-cursor.execute('''
-CREATE TABLE IF NOT EXISTS stall_attributes (
-    id INTEGER PRIMARY KEY,
-    stall_id INTEGER,
-    cuisine_type TEXT,
-    price_range TEXT,
-    dietary_requirements TEXT,
-    hpb_certified_items TEXT,
-    hpb_certification_reason TEXT,
-    avg_calorie_count INTEGER,
-    FOREIGN KEY (stall_id) REFERENCES stalls (id)
-)
-''')
+# The database is rebuilt from scratch on every run, so trade durability for load speed
+cursor.execute('PRAGMA journal_mode=WAL')
+cursor.execute('PRAGMA synchronous=OFF')
+cursor.execute('PRAGMA temp_store=MEMORY')
+cursor.execute('PRAGMA cache_size=-200000')
 
-# Load GeoJSON file
-print("Loading GeoJSON data...")
-with open('HealthierEateries.geojson', 'r') as file:
-    geojson_data = json.load(file)
+# Foreign keys are validated once after the load instead of on every row
+cursor.execute('PRAGMA foreign_keys=OFF')
+cursor.execute('PRAGMA defer_foreign_keys=ON')
 
-# Filter stalls within 5km of Bras Basah
-bras_basah_stalls = []
-for feature in geojson_data['features']:
-    geom = feature['geometry']
-    lon, lat = geom['coordinates'][0], geom['coordinates'][1]
-    
-    distance = calculate_distance(BRAS_BASAH_LAT, BRAS_BASAH_LON, lat, lon)
-    if distance <= MAX_DISTANCE_KM:
-        feature['distance'] = distance  # Add distance to feature
-        bras_basah_stalls.append(feature)
+# Stream only the coordinates from the GeoJSON file so the whole collection never sits in memory
+print("Loading GeoJSON data...")
+with open('HealthierEateries.geojson', 'rb') as file:
+    coords = ijson.items(file, 'features.item.geometry.coordinates', use_float=True)
+    coords = np.array(list(coords), dtype=np.float64)
 
-# Sort by distance from Bras Basah
-bras_basah_stalls.sort(key=lambda x: x['distance'])
+# Keep the 100 closest stalls within 5km (or less if there aren't that many within range)
+nearest, nearest_distances = find_nearest(coords[:, 1], coords[:, 0], 100, MAX_DISTANCE_KM)  # GeoJSON is [lon, lat]
 
-# Limit to 100 stalls (or less if there aren't that many within range)
-bras_basah_stalls = bras_basah_stalls[:min(100, len(bras_basah_stalls))]
+# Stream the features again, holding on to the nearest stalls only
+rank = {i: position for position, i in enumerate(nearest.tolist())}
+bras_basah_stalls = [None] * len(rank)
+with open('HealthierEateries.geojson', 'rb') as file:
+    for i, feature in enumerate(ijson.items(file, 'features.item', use_float=True)):
+        if i in rank:
+            position = rank[i]
+            feature['distance'] = float(nearest_distances[position])  # Add distance to feature
+            
+            # Extract data from Description field (HTML table) once for both passes below
+            desc_html = feature['properties'].get('Description', '')
+            feature['_extracted'] = dict(FIELD_RE.findall(desc_html))
+            bras_basah_stalls[position] = feature
 
 print(f"Found {len(bras_basah_stalls)} stalls within {MAX_DISTANCE_KM}km of Bras Basah.")
 
@@ -111,10 +102,10 @@ if not os.path.exists(csv_filename):
         
         for idx, feature in enumerate(bras_basah_stalls):
             props = feature['properties']
-            desc_html = props.get('Description', '')
+            fields = feature['_extracted']
             
             # Get the correct name from the NAME field inside the Description HTML
-            name = extract_from_description(desc_html, 'NAME')
+            name = fields.get('NAME', '')
             if not name:
                 name = props.get('Name', 'Unknown Eatery')
             
@@ -152,8 +143,10 @@ except Exception as e:
     conn.close()
     exit()
 
-# Process and insert the stalls with the CSV data
+# Process the stalls with the CSV data into rows for a single staging insert
 print("Processing stalls and inserting into database...")
+staged_rows = []
+seen_stalls = set()
 for idx, feature in enumerate(bras_basah_stalls):
     stall_id = str(idx + 1)
     if stall_id not in stall_data:
@@ -164,36 +157,42 @@ for idx, feature in enumerate(bras_basah_stalls):
     geom = feature['geometry']
     distance = feature['distance']
     
-    # Extract data from Description field (HTML table)
-    desc_html = props.get('Description', '')
+    # Fields from the Description HTML table, extracted while streaming the GeoJSON
+    fields = feature['_extracted']
     
     # Get the correct name from the NAME field inside the Description HTML
-    name = extract_from_description(desc_html, 'NAME')
+    name = fields.get('NAME', '')
     if not name:
         name = props.get('Name', 'Unknown Eatery')
     
     # Extract other fields
-    block_house_number = extract_from_description(desc_html, 'ADDRESSBLOCKHOUSENUMBER')
-    building_name = extract_from_description(desc_html, 'ADDRESSBUILDINGNAME')
-    postal_code = extract_from_description(desc_html, 'ADDRESSPOSTALCODE')
-    street_name = extract_from_description(desc_html, 'ADDRESSSTREETNAME')
-    floor_number = extract_from_description(desc_html, 'ADDRESSFLOORNUMBER')
-    unit_number = extract_from_description(desc_html, 'ADDRESSUNITNUMBER')
-    address_type = extract_from_description(desc_html, 'ADDRESSTYPE')
-    description = extract_from_description(desc_html, 'DESCRIPTION')
-    updated_date = extract_from_description(desc_html, 'FMEL_UPD_D')
+    block_house_number = fields.get('ADDRESSBLOCKHOUSENUMBER', '')
+    building_name = fields.get('ADDRESSBUILDINGNAME', '')
+    postal_code = fields.get('ADDRESSPOSTALCODE', '')
+    street_name = fields.get('ADDRESSSTREETNAME', '')
+    floor_number = fields.get('ADDRESSFLOORNUMBER', '')
+    unit_number = fields.get('ADDRESSUNITNUMBER', '')
+    address_type = fields.get('ADDRESSTYPE', '')
+    description = fields.get('DESCRIPTION', '')
+    updated_date = fields.get('FMEL_UPD_D', '')
+    
+    # Skip eateries that are listed more than once in the GeoJSON; malls share a postal
+    # code and can house several outlets of one chain, so the floor and unit are part of the key
+    stall_key = (name, postal_code, floor_number, unit_number)
+    if stall_key in seen_stalls:
+        print(f"Warning: Duplicate entry for {name} at stall ID {stall_id}. Skipping...")
+        continue
+    seen_stalls.add(stall_key)
     
     latitude = geom['coordinates'][1]  # GeoJSON is [lon, lat]
     longitude = geom['coordinates'][0]
     
-    # Insert into stalls table
-    cursor.execute('''
-    INSERT INTO stalls (
-        name, description, address_block, address_building, address_postal_code,
-        address_street, address_floor, address_unit, latitude, longitude,
-        address_type, last_updated, distance_from_bras_basah
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
+    # Get data from CSV
+    csv_data = stall_data[stall_id]
+    
+    # One staging row per stall and its attributes; the stall keeps the ID of its stall_data.csv row
+    staged_rows.append((
+        int(stall_id),
         name,
         description,
         block_house_number,
@@ -206,23 +205,7 @@ for idx, feature in enumerate(bras_basah_stalls):
         longitude,
         address_type,
         updated_date,
-        distance
-    ))
-    
-    # Get the stall ID from the database
-    db_stall_id = cursor.lastrowid
-    
-    # Get data from CSV
-    csv_data = stall_data[stall_id]
-    
-    # Insert attribute data from CSV
-    cursor.execute('''
-    INSERT INTO stall_attributes (
-        stall_id, cuisine_type, price_range, dietary_requirements, 
-        hpb_certified_items, hpb_certification_reason, avg_calorie_count
-    ) VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        db_stall_id,
+        distance,
         csv_data['cuisine_type'],
         csv_data['price_range'],
         csv_data['dietary_requirements'],
@@ -230,16 +213,164 @@ for idx, feature in enumerate(bras_basah_stalls):
         csv_data['hpb_certification_reason'],
         int(csv_data['avg_calorie_count'])
     ))
-    
-    # Print progress
-    if (idx + 1) % 10 == 0:
-        print(f"Processed {idx + 1} records...")
-        conn.commit()
 
-# Commit final changes and close connection
-conn.commit()
+# Rebuild every table in a single transaction, so a running API keeps reading the old
+# data until the new data is complete. Drop existing tables for a clean start, then
+# create them without secondary indexes; those are built after the data is loaded
+cursor.executescript('''
+BEGIN;
+
+DROP TABLE IF EXISTS stall_attributes;
+DROP TABLE IF EXISTS stalls;
+DROP TABLE IF EXISTS stall_dietary;
+DROP TABLE IF EXISTS filter_cache;
+
+CREATE TABLE IF NOT EXISTS stalls (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    description TEXT,
+    address_block TEXT,
+    address_building TEXT,
+    address_postal_code TEXT,
+    address_street TEXT,
+    address_floor TEXT,
+    address_unit TEXT,
+    latitude REAL,
+    longitude REAL,
+    address_type TEXT,
+    last_updated TEXT,
+    distance_from_bras_basah REAL
+);
+
+CREATE TABLE IF NOT EXISTS stall_attributes (
+    id INTEGER PRIMARY KEY,
+    stall_id INTEGER,
+    cuisine_type TEXT,
+    price_range TEXT,
+    dietary_requirements TEXT,
+    hpb_certified_items TEXT,
+    hpb_certification_reason TEXT,
+    avg_calorie_count INTEGER,
+    FOREIGN KEY (stall_id) REFERENCES stalls (id)
+);
+
+-- One row per stall and dietary tag, so the API can filter by tag through an index
+CREATE TABLE IF NOT EXISTS stall_dietary (
+    stall_id INTEGER,
+    tag TEXT COLLATE NOCASE
+);
+
+-- The values offered by the API's /filters endpoint, in display order
+CREATE TABLE IF NOT EXISTS filter_cache (
+    kind TEXT,
+    value TEXT,
+    sort_key REAL
+);
+''')
+
+# Insert everything into an in-memory staging table, then split it into the stalls
+# and stall_attributes tables with one statement each
+cursor.execute('''
+CREATE TEMP TABLE staging (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    description TEXT,
+    address_block TEXT,
+    address_building TEXT,
+    address_postal_code TEXT,
+    address_street TEXT,
+    address_floor TEXT,
+    address_unit TEXT,
+    latitude REAL,
+    longitude REAL,
+    address_type TEXT,
+    last_updated TEXT,
+    distance_from_bras_basah REAL,
+    cuisine_type TEXT,
+    price_range TEXT,
+    dietary_requirements TEXT,
+    hpb_certified_items TEXT,
+    hpb_certification_reason TEXT,
+    avg_calorie_count INTEGER
+)
+''')
+cursor.executemany(
+    'INSERT INTO staging VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+    staged_rows
+)
+
+cursor.execute('''
+INSERT INTO stalls (
+    id, name, description, address_block, address_building, address_postal_code,
+    address_street, address_floor, address_unit, latitude, longitude,
+    address_type, last_updated, distance_from_bras_basah
+)
+SELECT
+    id, name, description, address_block, address_building, address_postal_code,
+    address_street, address_floor, address_unit, latitude, longitude,
+    address_type, last_updated, distance_from_bras_basah
+FROM staging
+''')
+
+# Insert attribute data from CSV
+cursor.execute('''
+INSERT INTO stall_attributes (
+    id, stall_id, cuisine_type, price_range, dietary_requirements, 
+    hpb_certified_items, hpb_certification_reason, avg_calorie_count
+)
+SELECT
+    id, id, cuisine_type, price_range, dietary_requirements,
+    hpb_certified_items, hpb_certification_reason, avg_calorie_count
+FROM staging
+''')
+
+cursor.execute('DROP TABLE staging')
+
+# Split the comma-separated dietary requirements into one stall_dietary row per tag
+dietary_rows = []
+for stall_id, dietary_requirements in cursor.execute(
+    "SELECT stall_id, dietary_requirements FROM stall_attributes WHERE dietary_requirements != 'Unknown'"
+).fetchall():
+    if dietary_requirements:
+        tags = {tag.strip() for tag in dietary_requirements.split(',')}
+        dietary_rows.extend((stall_id, tag) for tag in tags if tag)
+cursor.executemany('INSERT INTO stall_dietary VALUES (?, ?)', dietary_rows)
+
+# Precompute the values for the API's filters; cuisine types keep their order of first
+# appearance, price ranges sort by their lower bound and dietary tags alphabetically
+cuisine_types = cursor.execute('''
+SELECT cuisine_type FROM stall_attributes WHERE cuisine_type != 'Unknown'
+GROUP BY cuisine_type ORDER BY MIN(rowid)
+''').fetchall()
+price_ranges = cursor.execute(
+    "SELECT DISTINCT price_range FROM stall_attributes WHERE price_range != 'Unknown'"
+).fetchall()
+dietary_tags = sorted(set(tag for _, tag in dietary_rows))
+
+filter_rows = (
+    [('cuisine_type', cuisine_type, position) for position, (cuisine_type,) in enumerate(cuisine_types)] +
+    [('price_range', price_range, price_sort_key(price_range)) for (price_range,) in price_ranges] +
+    [('dietary_requirement', tag, position) for position, tag in enumerate(dietary_tags)]
+)
+cursor.executemany('INSERT INTO filter_cache VALUES (?, ?, ?)', filter_rows)
+
+# Build the secondary indexes in one go now that the tables are filled, and gather
+# the statistics the query planner uses to pick between them
+cursor.execute('CREATE INDEX idx_sa_stall ON stall_attributes (stall_id)')
+cursor.execute('CREATE INDEX idx_sa_cuisine ON stall_attributes (cuisine_type, stall_id)')
+cursor.execute('CREATE INDEX idx_sa_price ON stall_attributes (price_range, stall_id)')
+cursor.execute('CREATE INDEX idx_sd ON stall_dietary (tag, stall_id)')
+cursor.execute('CREATE INDEX idx_filter_cache ON filter_cache (kind, sort_key)')
+cursor.execute('ANALYZE')
+cursor.execute('COMMIT')
+
+# Check the foreign keys that were not enforced during the load
+violations = cursor.execute('PRAGMA foreign_key_check').fetchall()
+if violations:
+    print(f"Warning: {len(violations)} stall attribute rows reference a missing stall.")
+
 conn.close()
 
 print("\nData import completed successfully!")
-print(f"Imported {len(bras_basah_stalls)} stalls within {MAX_DISTANCE_KM}km of Bras Basah.")
+print(f"Imported {len(staged_rows)} stalls within {MAX_DISTANCE_KM}km of Bras Basah.")
 print("The database now contains actual data from your CSV file.")
\ No newline at end of file
@@ -1,12 +1,23 @@
 # main.py
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel
 from typing import List, Optional
-import sqlite3
+import asyncio
+import itertools
+import json
+import logging
 import math
+import signal
+import threading
+import aiosqlite
+import msgpack
+import numpy as np
 
-app = FastAPI(title="HPB Food Finder API")
+app = FastAPI(title="HPB Food Finder API", default_response_class=ORJSONResponse)
+
+logger = logging.getLogger(__name__)
 
 # Add CORS middleware to allow React Native app to connect
 app.add_middleware(
@@ -17,11 +28,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database connection function
+# Database connection; one aiosqlite connection is opened at startup and shared by
+# all requests, so queries never block the event loop. The data loader builds the
+# whole database, including its indexes, so the API only ever reads from it
+@app.on_event("startup")
+async def open_db_connection():
+    conn = await aiosqlite.connect('file:hpb_food_stalls.db?mode=ro', uri=True)
+    conn.row_factory = aiosqlite.Row
+    await conn.execute('PRAGMA mmap_size=268435456')
+    await conn.execute('PRAGMA cache_size=-65536')
+    app.state.db = conn
+
+@app.on_event("shutdown")
+async def close_db_connection():
+    await app.state.db.close()
+
 def get_db_connection():
-    conn = sqlite3.connect('hpb_food_stalls.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return app.state.db
 
 # Pydantic models for data validation
 class StallAttribute(BaseModel):
@@ -46,200 +69,332 @@ class Stall(BaseModel):
     attributes: Optional[StallAttribute] = None
     distance: Optional[float] = None
 
-# Helper function to calculate distance between two points
-def calculate_distance(lat1, lon1, lat2, lon2):
-    # Haversine formula
-    R = 6371  # Radius of Earth in km
-    dLat = math.radians(lat2 - lat1)
-    dLon = math.radians(lon2 - lon1)
-    a = (math.sin(dLat/2) * math.sin(dLat/2) +
-         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-         math.sin(dLon/2) * math.sin(dLon/2))
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    return distance
+# Helper function to calculate distances from one point to arrays of points, given
+# the points' coordinates in radians and the cosines of their latitudes
+def calculate_distances(lat1, lon1, lats_rad, lons_rad, cos_lats):
+    # Haversine formula; 2*asin(sqrt(a)) equals 2*atan2(sqrt(a), sqrt(1-a)) with fewer operations
+    D = 12742.0  # Diameter of Earth in km
+    lat1_rad = math.radians(lat1)
+    lon1_rad = math.radians(lon1)
+    a = (np.sin((lats_rad - lat1_rad)*0.5)**2 +
+         math.cos(lat1_rad) * cos_lats * np.sin((lons_rad - lon1_rad)*0.5)**2)
+    distances = D * np.arcsin(np.sqrt(a))
+    return distances
+
+# Helper function to find the stalls that may lie within a radius, using the cheap
+# equirectangular approximation instead of Haversine
+def equirectangular_candidates(latitude, longitude, radius):
+    KM_PER_DEGREE = math.pi * 6371 / 180  # Length of one degree on the Haversine sphere
+    
+    # Take cos(latitude) where it is smallest within the radius, so the approximation
+    # never overestimates and no stall that is actually in range gets dropped
+    lat_band = radius / KM_PER_DEGREE
+    cos_lat = math.cos(math.radians(min(abs(latitude) + lat_band, 90)))
+    
+    dx = ((LONS - longitude + 180) % 360 - 180) * cos_lat
+    dy = LATS - latitude
+    approx = KM_PER_DEGREE * np.sqrt(dx*dx + dy*dy)
+    return np.flatnonzero(approx <= radius * 1.001)
+
+# Stall coordinates kept in memory as arrays (ordered by stall ID) for distance calculations,
+# along with their radians and latitude cosines, which never change between requests
+IDS = np.empty(0, dtype=np.int64)
+LATS = np.empty(0, dtype=np.float64)
+LONS = np.empty(0, dtype=np.float64)
+LATS_RAD = np.empty(0, dtype=np.float64)
+LONS_RAD = np.empty(0, dtype=np.float64)
+COS_LATS = np.empty(0, dtype=np.float64)
+
+@app.on_event("startup")
+async def load_stall_coordinates():
+    global IDS, LATS, LONS, LATS_RAD, LONS_RAD, COS_LATS
+    conn = get_db_connection()
+    
+    # Note the data version before reading, so that a load committed in between is
+    # picked up by the next request instead of being missed
+    data_version = await read_data_version()
+    rows = await conn.execute_fetchall("SELECT id, latitude, longitude FROM stalls ORDER BY id")
+    
+    ids = np.array([row['id'] for row in rows], dtype=np.int64)
+    lats = np.array([row['latitude'] for row in rows], dtype=np.float64)
+    lons = np.array([row['longitude'] for row in rows], dtype=np.float64)
+    lats_rad = np.radians(lats)
+    
+    # Swap all arrays in together so a request never sees them half reloaded
+    IDS, LATS, LONS, LATS_RAD, LONS_RAD, COS_LATS = (
+        ids, lats, lons, lats_rad, np.radians(lons), np.cos(lats_rad)
+    )
+    app.state.data_version = data_version
+
+# Columns selected for a stall and its attributes, read by position in stall_from_row
+STALL_COLUMNS = """
+    s.id, s.name, s.description, s.address_building, s.address_postal_code,
+    s.address_street, s.address_floor, s.address_unit, s.latitude, s.longitude,
+    sa.cuisine_type, sa.price_range, sa.dietary_requirements,
+    sa.hpb_certified_items, sa.hpb_certification_reason, sa.avg_calorie_count
+"""
+
+# Helper function to build a Stall as a plain dict from a row of STALL_COLUMNS; the
+# data comes straight from our own database, so it is not validated and orjson can
+# serialize it without going through Pydantic
+def stall_from_row(row, distance=None):
+    return {
+        "id": row[0],
+        "name": row[1],
+        "description": row[2],
+        "address_building": row[3],
+        "address_postal_code": row[4],
+        "address_street": row[5],
+        "address_floor": row[6],
+        "address_unit": row[7],
+        "latitude": row[8],
+        "longitude": row[9],
+        "attributes": {
+            "cuisine_type": row[10],
+            "price_range": row[11],
+            "dietary_requirements": row[12],
+            "hpb_certified_items": row[13],
+            "hpb_certification_reason": row[14],
+            "avg_calorie_count": row[15]
+        },
+        "distance": distance
+    }
+
+# Helper function to tell whether an Accept header prefers msgpack to JSON; each type
+# gets the q-value of the most specific media range that matches it, and on a tie
+# JSON stays the default
+def prefers_msgpack(accept):
+    qualities = {}
+    for media_range in accept.split(','):
+        media_type, *params = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type:
+            qualities[media_type.lower()] = quality
+    
+    def quality_of(media_type):
+        for media_range in (media_type, media_type.split('/')[0] + '/*', '*/*'):
+            if media_range in qualities:
+                return qualities[media_range]
+        return 0.0
+    
+    msgpack_quality = quality_of('application/msgpack')
+    return msgpack_quality > 0 and msgpack_quality > quality_of('application/json')
+
+# Helper function to pack stalls as msgpack columns, one array per field, which is
+# smaller and much faster for clients to decode than a JSON array of objects
+def stalls_to_msgpack(stalls):
+    columns = {
+        field: [stall[field] for stall in stalls]
+        for field in Stall.__fields__ if field != 'attributes'
+    }
+    columns['attributes'] = {
+        field: [stall['attributes'][field] for stall in stalls]
+        for field in StallAttribute.__fields__
+    }
+    return msgpack.packb(columns)
+
+# Helper function to send /stalls results as msgpack columns or JSON; the format can
+# depend on the Accept header, so shared caches must key the response on it too
+def stalls_response(stalls, as_msgpack):
+    headers = {"Vary": "Accept"}
+    if as_msgpack:
+        return Response(content=stalls_to_msgpack(stalls), media_type="application/msgpack", headers=headers)
+    return ORJSONResponse(stalls, headers=headers)
+
+# Helper function to build the /stalls query for a combination of filters
+def build_stalls_query(has_location, has_cuisine_type, has_price_range, has_dietary):
+    # The stall IDs within the radius are passed as one JSON array, nearest first, so
+    # the query text stays the same and the array position gives the distance order
+    nearest_join = "JOIN json_each(?) nearest ON nearest.value = s.id" if has_location else ""
+    query = f"""
+    SELECT {STALL_COLUMNS}
+    FROM stalls s
+    {nearest_join}
+    JOIN stall_attributes sa ON s.id = sa.stall_id
+    WHERE 1=1
+    """
+    
+    if has_cuisine_type:
+        query += " AND sa.cuisine_type = ?"
+    
+    if has_price_range:
+        query += " AND sa.price_range = ?"
+    
+    # Dietary requirements are matched by tag through the stall_dietary index
+    if has_dietary:
+        query += " AND s.id IN (SELECT stall_id FROM stall_dietary WHERE tag = ?)"
+    
+    # With a limit SQLite's sorter only keeps the nearest rows; a limit of -1 returns every row
+    if has_location:
+        query += " ORDER BY nearest.key"
+    query += " LIMIT ?"
+    
+    return query
+
+# Every filter combination maps to one fixed query text, so SQLite's statement
+# cache on each connection reuses the compiled statement across requests
+STALLS_QUERIES = {
+    filters: build_stalls_query(*filters)
+    for filters in itertools.product((False, True), repeat=4)
+}
 
 # API Routes
 @app.get("/")
-def read_root():
+async def read_root():
     return {"message": "Welcome to HPB Food Finder API"}
 
-@app.get("/stalls", response_model=List[Stall])
-def get_stalls(
+# The stall routes return their plain dicts as an ORJSONResponse, which skips FastAPI's
+# validation and jsonable_encoder pass; responses still documents the Stall schema
+@app.get("/stalls", response_model=None, responses={200: {"model": List[Stall]}})
+async def get_stalls(
     latitude: Optional[float] = Query(None, description="User's current latitude"),
     longitude: Optional[float] = Query(None, description="User's current longitude"),
     radius: Optional[float] = Query(1.0, description="Search radius in kilometers"),
     cuisine_type: Optional[str] = Query(None, description="Filter by cuisine type"),
     price_range: Optional[str] = Query(None, description="Filter by price range"),
-    dietary: Optional[str] = Query(None, description="Filter by dietary requirements")
+    dietary: Optional[str] = Query(None, description="Filter by dietary requirements"),
+    limit: Optional[int] = Query(None, ge=1, description="Maximum number of stalls to return"),
+    response_format: Optional[str] = Query(None, alias="format", description="Set to 'msgpack' for columnar msgpack"),
+    accept: Optional[str] = Header(None)
 ):
+    # Clients can ask for msgpack columns instead of JSON with either the query or the header
+    as_msgpack = response_format == 'msgpack' or prefers_msgpack(accept or '')
+    
+    await ensure_current_data()
+    
+    # Coordinates of 0.0 (the equator or prime meridian) are still a location
+    has_location = latitude is not None and longitude is not None
+    
+    # Find the stalls within the search radius from the in-memory coordinates first
+    if has_location:
+        candidates = equirectangular_candidates(latitude, longitude, radius)
+        distances = calculate_distances(
+            latitude, longitude,
+            LATS_RAD[candidates], LONS_RAD[candidates], COS_LATS[candidates]
+        )
+        
+        # Skip stalls outside the search radius and sort the rest by distance
+        in_radius = np.flatnonzero(distances <= radius)
+        nearest = in_radius[np.argsort(distances[in_radius], kind='stable')]
+        
+        # Without attribute filters the nearest stalls are exactly the ones returned,
+        # so only those are looked up in the database
+        if limit is not None and not (cuisine_type or price_range or dietary):
+            nearest = nearest[:limit]
+        distance_by_id = {int(IDS[candidates[i]]): round(float(distances[i]), 2) for i in nearest}
+        if not distance_by_id:
+            return stalls_response([], as_msgpack)
+    
     conn = get_db_connection()
     
-    # Build query based on filters
-    query = """
-    SELECT s.*, sa.cuisine_type, sa.price_range, sa.dietary_requirements, 
-           sa.hpb_certified_items, sa.hpb_certification_reason, sa.avg_calorie_count
-    FROM stalls s
-    JOIN stall_attributes sa ON s.id = sa.stall_id
-    WHERE 1=1
-    """
+    # Pick the prepared query for the given filters
+    query = STALLS_QUERIES[(has_location, bool(cuisine_type), bool(price_range), bool(dietary))]
     params = []
     
+    # Only fetch the full rows of stalls within the search radius
+    if has_location:
+        params.append(json.dumps(list(distance_by_id)))
+    
     if cuisine_type:
-        query += " AND sa.cuisine_type = ?"
         params.append(cuisine_type)
     
     if price_range:
-        query += " AND sa.price_range = ?"
         params.append(price_range)
     
     if dietary:
-        query += " AND sa.dietary_requirements LIKE ?"
-        params.append(f"%{dietary}%")
+        params.append(dietary)
     
-    results = conn.execute(query, params).fetchall()
+    params.append(limit if limit is not None else -1)
     
-    # Filter by distance if coordinates are provided
-    stalls = []
-    for row in results:
-        stall_data = dict(row)
-        
-        # If user location is provided, calculate distance and filter by radius
-        if latitude and longitude:
-            distance = calculate_distance(
-                latitude, longitude, 
-                stall_data['latitude'], stall_data['longitude']
-            )
-            
-            # Skip stalls outside the search radius
-            if distance > radius:
-                continue
-                
-            # Add distance to stall data
-            stall_data['distance'] = round(distance, 2)
-        
-        # Format the stall data to match Pydantic model
-        attributes = {
-            'cuisine_type': stall_data.pop('cuisine_type'),
-            'price_range': stall_data.pop('price_range'),
-            'dietary_requirements': stall_data.pop('dietary_requirements'),
-            'hpb_certified_items': stall_data.pop('hpb_certified_items'),
-            'hpb_certification_reason': stall_data.pop('hpb_certification_reason'),
-            'avg_calorie_count': stall_data.pop('avg_calorie_count')
-        }
-        
-        stall_data['attributes'] = attributes
-        stalls.append(stall_data)
+    results = await conn.execute_fetchall(query, params)
     
-    # Sort by distance if coordinates were provided
-    if latitude and longitude:
-        stalls.sort(key=lambda x: x.get('distance', float('inf')))
+    # The rows already come in order of distance if coordinates are provided
+    if has_location:
+        stalls = [stall_from_row(row, distance_by_id[row[0]]) for row in results]
+    else:
+        stalls = [stall_from_row(row) for row in results]
     
-    conn.close()
-    return stalls
+    return stalls_response(stalls, as_msgpack)
 
-@app.get("/stalls/{stall_id}", response_model=Stall)
-def get_stall(stall_id: int):
+@app.get("/stalls/{stall_id}", response_model=None, responses={200: {"model": Stall}})
+async def get_stall(stall_id: int):
     conn = get_db_connection()
     
     # Get stall details and attributes
-    query = """
-    SELECT s.*, sa.cuisine_type, sa.price_range, sa.dietary_requirements,
-           sa.hpb_certified_items, sa.hpb_certification_reason, sa.avg_calorie_count
+    query = f"""
+    SELECT {STALL_COLUMNS}
     FROM stalls s
     JOIN stall_attributes sa ON s.id = sa.stall_id
     WHERE s.id = ?
     """
-    result = conn.execute(query, (stall_id,)).fetchone()
+    results = await conn.execute_fetchall(query, (stall_id,))
     
-    if not result:
-        conn.close()
+    if not results:
         raise HTTPException(status_code=404, detail="Stall not found")
     
-    stall_data = dict(result)
-    
-    # Format the stall data to match Pydantic model
-    attributes = {
-        'cuisine_type': stall_data.pop('cuisine_type'),
-        'price_range': stall_data.pop('price_range'),
-        'dietary_requirements': stall_data.pop('dietary_requirements'),
-        'hpb_certified_items': stall_data.pop('hpb_certified_items'),
-        'hpb_certification_reason': stall_data.pop('hpb_certification_reason'),
-        'avg_calorie_count': stall_data.pop('avg_calorie_count')
-    }
-    
-    stall_data['attributes'] = attributes
-    conn.close()
-    
-    return stall_data
+    return ORJSONResponse(stall_from_row(results[0]))
 
-@app.get("/filters")
-def get_filters():
-    """Get the list of available filters for the app"""
+# The filters and database stats only change when the data loader is re-run,
+# so they are computed once and cached until the stall data is reloaded
+RESPONSE_CACHE = {}
+
+# Held while refreshing, and while filling RESPONSE_CACHE so that a response computed
+# from the old data is never stored after a refresh has cleared it
+REFRESH_LOCK = asyncio.Lock()
+
+async def compute_filters():
     conn = get_db_connection()
     
-    # Get all distinct cuisine types
-    cuisine_types = conn.execute(
-        "SELECT DISTINCT cuisine_type FROM stall_attributes WHERE cuisine_type != 'Unknown'"
-    ).fetchall()
-    
-    # Get all distinct price ranges
-    price_ranges = conn.execute(
-        "SELECT DISTINCT price_range FROM stall_attributes WHERE price_range != 'Unknown'"
-    ).fetchall()
-    
-    # Get all distinct dietary requirements
-    # Since dietary requirements are stored as comma-separated values,
-    # we need to split and extract unique values
-    dietary_reqs_raw = conn.execute(
-        "SELECT dietary_requirements FROM stall_attributes WHERE dietary_requirements != 'Unknown'"
-    ).fetchall()
-    
-    # Process dietary requirements to get unique values
-    all_dietary_reqs = []
-    for row in dietary_reqs_raw:
-        if row['dietary_requirements']:
-            reqs = [req.strip() for req in row['dietary_requirements'].split(',')]
-            all_dietary_reqs.extend(reqs)
-    
-    # Get unique dietary requirements
-    unique_dietary_reqs = sorted(set(all_dietary_reqs))
-    
-    conn.close()
+    async def filter_values(kind):
+        rows = await conn.execute_fetchall(
+            "SELECT value FROM filter_cache WHERE kind = ? ORDER BY sort_key, rowid", (kind,)
+        )
+        return [row['value'] for row in rows]
     
     return {
-        "cuisine_types": [row['cuisine_type'] for row in cuisine_types],
-        "price_ranges": sorted([row['price_range'] for row in price_ranges], 
-                              key=lambda x: float(x.split('-')[0].replace('+', ''))),
-        "dietary_requirements": unique_dietary_reqs
+        "cuisine_types": await filter_values('cuisine_type'),
+        "price_ranges": await filter_values('price_range'),
+        "dietary_requirements": await filter_values('dietary_requirement')
     }
 
-# Add a debug endpoint to verify database data
-@app.get("/debug/database")
-def debug_database():
-    """Return database statistics and sample data for debugging"""
+@app.get("/filters")
+async def get_filters():
+    """Get the list of available filters for the app"""
+    await ensure_current_data()
+    if 'filters' not in RESPONSE_CACHE:
+        async with REFRESH_LOCK:
+            if 'filters' not in RESPONSE_CACHE:
+                RESPONSE_CACHE['filters'] = await compute_filters()
+    return RESPONSE_CACHE['filters']
+
+async def compute_database_stats():
     conn = get_db_connection()
     
     # Get total count of stalls
-    stall_count = conn.execute("SELECT COUNT(*) FROM stalls").fetchone()[0]
+    stall_count = (await conn.execute_fetchall("SELECT COUNT(*) FROM stalls"))[0][0]
     
     # Get 5 sample stalls with attributes
-    sample_stalls = conn.execute("""
+    sample_stalls = await conn.execute_fetchall("""
         SELECT s.id, s.name, s.latitude, s.longitude, 
                sa.cuisine_type, sa.price_range, sa.dietary_requirements
         FROM stalls s
         JOIN stall_attributes sa ON s.id = sa.stall_id
         LIMIT 5
-    """).fetchall()
+    """)
     
     # Get counts by cuisine type
-    cuisine_counts = conn.execute("""
+    cuisine_counts = await conn.execute_fetchall("""
         SELECT cuisine_type, COUNT(*) as count 
         FROM stall_attributes 
         GROUP BY cuisine_type
-    """).fetchall()
-    
-    conn.close()
+    """)
     
     return {
         "total_stalls": stall_count,
@@ -247,4 +402,63 @@ def debug_database():
         "cuisine_counts": [dict(row) for row in cuisine_counts]
     }
 
+# Add a debug endpoint to verify database data
+@app.get("/debug/database")
+async def debug_database():
+    """Return database statistics and sample data for debugging"""
+    await ensure_current_data()
+    if 'database_stats' not in RESPONSE_CACHE:
+        async with REFRESH_LOCK:
+            if 'database_stats' not in RESPONSE_CACHE:
+                RESPONSE_CACHE['database_stats'] = await compute_database_stats()
+    return RESPONSE_CACHE['database_stats']
+
+# Helper function to pick up a database rebuilt by the data loader; overlapping
+# refreshes run one after the other instead of interleaving their reloads
+async def refresh_stall_data():
+    async with REFRESH_LOCK:
+        await load_stall_coordinates()
+        RESPONSE_CACHE.clear()
+
+# Helper function to read the database's data version, which changes on this connection
+# whenever another connection, such as the data loader, commits
+async def read_data_version():
+    rows = await get_db_connection().execute_fetchall('PRAGMA data_version')
+    return rows[0][0]
+
+# Helper function to reload the stall data before serving a request if the database has
+# changed since it was loaded, so re-running the data loader takes effect right away
+async def ensure_current_data():
+    if await read_data_version() != app.state.data_version:
+        async with REFRESH_LOCK:
+            # Another request may have reloaded the data while this one waited
+            if await read_data_version() != app.state.data_version:
+                await load_stall_coordinates()
+                RESPONSE_CACHE.clear()
+
+# Helper function to refresh from the SIGHUP handler, where nothing awaits the task
+# and a failure would otherwise go unreported
+async def refresh_on_signal():
+    try:
+        await refresh_stall_data()
+    except Exception:
+        logger.exception("Refreshing stall data on SIGHUP failed")
+
+# The event loop only keeps weak references to tasks, so the refresh tasks started by
+# SIGHUP are held here until they finish
+SIGNAL_TASKS = set()
+
+def start_signal_refresh():
+    task = asyncio.ensure_future(refresh_on_signal())
+    SIGNAL_TASKS.add(task)
+    task.add_done_callback(SIGNAL_TASKS.discard)
+
+# Force a refresh on SIGHUP (re-running the data loader is picked up without one);
+# signal handlers can only be installed when the event loop runs in the main thread,
+# as it does under uvicorn
+@app.on_event("startup")
+async def install_refresh_signal_handler():
+    if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, start_signal_refresh)
+
 # Run with: uvicorn main:app --reload
\ No newline at end of file